@@ -1,10 +1,13 @@
 # coding=utf-8
 
-import glob
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 import logging
+import mmap
+import operator
 import os
 import re
-import struct
+import threading
 
 from dipy.io.utils import is_header_compatible
 import nibabel as nib
@@ -12,6 +15,37 @@ import numpy as np
 
 from scilpy.utils.util import str_to_index
 
+# Extracts floating point numbers
+# ex: 'float  roi[] = {3.840000,3.840000,0.035000};'
+# returns ['3.840000', '3.840000', '0.035000']
+_FLOAT_RE = re.compile(rb'[-+]?[0-9]*\.?[0-9]+')
+
+# Extracts the tag and the value of each declaration of the header.
+# ex: 'float  roi[] = {3.840000,3.840000,0.035000};'
+# returns ('roi', '{3.840000,3.840000,0.035000}')
+_DECLARATION_RE = re.compile(
+    rb'^\w+[ \t]*\**[ \t]*(\w+)(?:\[\])?[ \t]*=[ \t]*(.*);', re.MULTILINE)
+
+# Extracts units in quotes.
+# ex: 'char  *abscissa[] = {"cm", "cm"}' returns ['"cm"', '"cm"']
+_ABSCISSA_RE = re.compile(rb'"[a-z]{2}"')
+
+# Extracts digits.
+# ex: 'float  matrix[] = {128, 128};' returns ['128', '128']
+_MATRIX_RE = re.compile(rb'(\d+)')
+
+# fdf headers are a few kilobytes, they are read by chunks of this size
+_HEADER_CHUNK_SIZE = 8192
+
+# Header fields stored as named values (tag_in_file: tag_in_header)
+_FIND_VALUES = {b'echos': 'nechoes',
+                b'echo_no': 'echo_no',
+                b'nslices': 'nslices',
+                b'slice_no': 'sl',
+                b'bigendian': 'endian',
+                b'array_dim': 'array_dim',
+                b'studyid': 'studyid'}
+
 
 def load_fdf(file_path):
     """
@@ -60,24 +94,29 @@ def add_gradient_info(procpar_path, header):
     ------
     None
     """
-    bval = diff_x = diff_y = diff_z = None
+    # (tag_in_file, tag_in_header)
+    find_values = {b'bvalue': 'bvalue',
+                   b'dpe': 'diff_x',
+                   b'dro': 'diff_y',
+                   b'dsl': 'diff_z'}
+    gradients = dict()
 
-    with open(procpar_path, 'r') as procpar:
+    with open(procpar_path, 'rb') as procpar:
         for line in procpar:
-            if line.startswith('bvalue'):
-                bval = next(procpar)
-            if line.startswith('dpe '):
-                diff_x = next(procpar)
-            if line.startswith('dro '):
-                diff_y = next(procpar)
-            if line.startswith('dsl '):
-                diff_z = next(procpar)
-
-    if bval and diff_x and diff_y and diff_z:
-        header['bvalue'] = [float(x) for x in bval.split()[1:]]
-        header['diff_x'] = [-float(x) for x in diff_x.split()[1:]]
-        header['diff_y'] = [float(x) for x in diff_y.split()[1:]]
-        header['diff_z'] = [float(x) for x in diff_z.split()[1:]]
+            head_key = find_values.pop(line.split(b' ', 1)[0], None)
+            if head_key is None:
+                continue
+
+            # Values are on the next line, preceded by their count
+            values = next(procpar).partition(b' ')[2]
+            gradients[head_key] = np.fromstring(values, dtype=np.float64,
+                                                sep=' ')
+            if not find_values:
+                break
+
+    if not find_values:
+        gradients['diff_x'] = -gradients['diff_x']
+        header.update(gradients)
 
 
 def read_file(file_path):
@@ -93,119 +132,233 @@ def read_file(file_path):
     raw_header: Dictionary of header information
     data: Numpy array of the fdf data
     """
-    raw_header = dict()
+    with open(file_path, 'rb') as fp:
+        raw_header, nb_voxels, dtype = _scan_header(fp)
+        data = _load_payload(fp, nb_voxels, dtype, raw_header['shape'])
 
-    raw_header['shape'] = [-1, -1, 1, 1]
-    raw_header['endian'] = '>'
+    return raw_header, data
 
-    # Extracts floating point numbers
-    # ex: 'float  roi[] = {3.840000,3.840000,0.035000};'
-    # returns ['3.840000', '3.840000', '0.035000']
-    float_regex = '[-+]?[0-9]*\.?[0-9]+'
 
-    # Extracts value of a line of the type:
-    # 'int    slice_no = 1;' would return '1'
-    named_value_regex = '= *\"*(.*[^\"])\"* *;'
+def _parse_abscissa(raw_header, value):
+    """Set the spatial and temporal units from an abscissa value."""
+    m = _ABSCISSA_RE.findall(value)
 
-    # (tag_in_file, tag_in_header)
-    find_values = (('echos', 'nechoes'),
-                   ('echo_no', 'echo_no'),
-                   ('nslices', 'nslices'),
-                   ('slice_no', 'sl'),
-                   ('bigendian', 'endian'),
-                   ('array_dim', 'array_dim'),
-                   ('bigendian', 'endian'),
-                   ('studyid', 'studyid'))
+    unit = m[0].strip(b'"').decode('ascii')
 
-    with open(file_path, 'rb') as fp:
-        # Read entire file
-        while True:
-            line = fp.readline()
-            line = line.decode()
+    # We convert everything in mm
+    # Nifti doesn't support 'cm' anyway...
+    if unit == 'cm':
+        unit = 'mm'
 
-            if line[0] == chr(12):
-                break
+    raw_header['xyz_units'] = unit
+    raw_header['t_units'] = 'unknown'
 
-            # Check line for tag, extract value with the regex then put it in
-            # the header with the associated tag.
-            for file_key, head_key in find_values:
-                if line.find(file_key) > 0:
-                    raw_header[head_key] = \
-                        re.findall(named_value_regex, line)[0]
-                    break
-
-            if type(raw_header['endian']) is int:
-                raw_header['endian'] = \
-                    '>' if int(raw_header['endian']) != 0 else '<'
-
-            if line.find('abscissa') > 0:
-                # Extracts units in quotes.
-                # ex: 'char  *abscissa[] = {"cm", "cm"}' returns
-                # ["cm", "cm"]
-                m = re.findall('\"[a-z]{2}\"', line.rstrip())
-
-                unit = m[0].strip('"')
-
-                # We convert everything in mm
-                # Nifti doesn't support 'cm' anyway...
-                if unit == 'cm':
-                    unit = 'mm'
-
-                raw_header['xyz_units'] = unit
-                raw_header['t_units'] = 'unknown'
-
-            elif line.find('roi') > 0:
-                m = re.findall(float_regex, line.rstrip())
-                raw_header['real_voxel_dim'] = \
-                    np.array([float(x)*10 for x in m])
-
-            elif line.find('orientation') > 0:
-                m = re.findall(float_regex, line.rstrip())
-                raw_header['orientation'] = np.array([float(x) for x in m])
-
-            elif line.find('origin') > 0:
-                m = re.findall(float_regex, line.rstrip())
-                raw_header['origin'] = \
-                    np.array([float(x) for x in m])
-
-            elif line.find('matrix') > 0:
-                # Extracts digits.
-                # ex: 'float  matrix[] = {128, 128};'
-                # returns ['128', '128']
-                m = re.findall('(\d+)', line.rstrip())
-                raw_header['shape'] = np.array([int(x) for x in m])
-
-        # Total number of data pixels
-        # nb_voxels = reduce(operator.mul, raw_header['shape'])
-        nb_voxels = np.prod(raw_header['shape'])
-
-        # Set how data is packed
-        raw_header['fmt'] = "{}f".format(nb_voxels)
-        if '<' in raw_header['endian']:
-            raw_header['fmt'] = '<'+raw_header['fmt']
-        else:
-            raw_header['fmt'] = '>'+raw_header['fmt']
 
-        # Go to the beginning of the data segment
-        fp.seek(-nb_voxels * 4, 2)
-        data = struct.unpack(raw_header['fmt'], fp.read(nb_voxels*4))
+def _parse_roi(raw_header, value):
+    """Set the field of view, in mm, from a roi value in cm."""
+    m = _FLOAT_RE.findall(value)
+    raw_header['real_voxel_dim'] = np.array([float(x)*10 for x in m])
+
+
+def _parse_orientation(raw_header, value):
+    """Set the orientation from an orientation value."""
+    m = _FLOAT_RE.findall(value)
+    raw_header['orientation'] = np.array([float(x) for x in m])
+
+
+def _parse_origin(raw_header, value):
+    """Set the origin from an origin value."""
+    m = _FLOAT_RE.findall(value)
+    raw_header['origin'] = np.array([float(x) for x in m])
+
+
+def _parse_matrix(raw_header, value):
+    """Set the image dimensions from a matrix value."""
+    m = _MATRIX_RE.findall(value)
+    raw_header['shape'] = np.array([int(x) for x in m])
+
+
+# Header fields needing more than a named value (tag_in_file: parser)
+_HEADER_PARSERS = {b'abscissa': _parse_abscissa,
+                   b'roi': _parse_roi,
+                   b'orientation': _parse_orientation,
+                   b'origin': _parse_origin,
+                   b'matrix': _parse_matrix}
+
+
+def _scan_header(fp):
+    """
+    Parse the header of an opened fdf file.
+
+    Parameters
+    ----------
+    fp: fdf file opened in binary mode, positioned at its beginning
+
+    Return
+    ------
+    raw_header: Dictionary of header information
+    nb_voxels: Number of data pixels
+    dtype: Numpy dtype of the data pixels
+    """
+    raw_header = dict()
+
+    raw_header['endian'] = '>'
+
+    # Check each declaration for tag, then put its value in the header with
+    # the associated tag or parse it with the associated parser.
+    for tag, value in _DECLARATION_RE.findall(_read_header(fp)):
+        head_key = _FIND_VALUES.get(tag)
+        if head_key is not None:
+            raw_header[head_key] = value.rstrip().strip(b'"').decode('ascii')
+        elif tag in _HEADER_PARSERS:
+            _HEADER_PARSERS[tag](raw_header, value)
+
+    missing = [tag for tag, head_key in (('matrix', 'shape'),
+                                         ('roi', 'real_voxel_dim'))
+               if head_key not in raw_header]
+    if missing:
+        raise Exception('Could not find {0} in the header of {1}.'
+                        .format(', '.join(missing), fp.name))
+
+    if type(raw_header['endian']) is int:
+        raw_header['endian'] = \
+            '>' if int(raw_header['endian']) != 0 else '<'
+
+    # Total number of data pixels, as a python int
+    nb_voxels = reduce(operator.mul, [int(x) for x in raw_header['shape']])
+
+    # Set how data is packed
+    dtype = np.dtype('<f4' if '<' in raw_header['endian'] else '>f4')
 
     # Get correct voxel dimensions in mm
+    # roi always has 3 values while a 2D matrix only has 2
+    nb_dims = len(raw_header['shape'])
     raw_header['voxel_dim'] = \
-        [j/i for i, j in zip(raw_header['shape'],
-                             raw_header['real_voxel_dim'])]
+        (raw_header['real_voxel_dim'][:nb_dims] / raw_header['shape']).tolist()
 
-    correct_shape = raw_header['shape'][::-1]
+    return raw_header, nb_voxels, dtype
 
-    # Reshape the data according to image dimensions
-    data = np.array(data).reshape(correct_shape).squeeze()
 
-    if len(raw_header['shape']) != 2:
-        data = data.transpose(2, 1, 0)
+def _read_matrix(fp):
+    """
+    Read only the image dimensions of an opened fdf file.
 
-    data = np.rot90(data, 3)[:, ::-1]
+    Parameters
+    ----------
+    fp: fdf file opened in binary mode, positioned at its beginning
 
-    return raw_header, data
+    Return
+    ------
+    shape: List of the image dimensions, None if there is no matrix
+    """
+    for tag, value in _DECLARATION_RE.findall(_read_header(fp)):
+        if tag == b'matrix':
+            return [int(x) for x in _MATRIX_RE.findall(value)]
+
+    return None
+
+
+def _read_header(fp):
+    """
+    Read the header of an opened fdf file in a few large reads.
+
+    Parameters
+    ----------
+    fp: fdf file opened in binary mode, positioned at its beginning
+
+    Return
+    ------
+    header: Header text, without the form feed separating it from the data
+    """
+    header = bytearray()
+    while True:
+        chunk = fp.read(_HEADER_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        # The header is separated from the data by a form feed starting a
+        # line. The search starts one byte early in case the chunk boundary
+        # splits the separator.
+        start = max(len(header) - 1, 0)
+        header += chunk
+        end = header.find(b'\n\x0c', start)
+        if end >= 0:
+            del header[end:]
+            break
+
+    return bytes(header)
+
+
+def _load_payload(fp, nb_voxels, dtype, shape, out=None, buf=None):
+    """
+    Load the data segment of an opened fdf file.
+
+    Parameters
+    ----------
+    fp: fdf file opened in binary mode
+    nb_voxels: Number of data pixels
+    dtype: Numpy dtype of the data pixels
+    shape: Image dimensions, as found in the header matrix
+    out: Array (or view) in which the data is written. Must have the shape
+        of the reoriented data. A new array is returned if None.
+    buf: Writable buffer of nb_voxels * 4 bytes in which the data segment is
+        read, to reuse across files. The file is memory-mapped if None.
+
+    Return
+    ------
+    out: Numpy array of the fdf data
+    """
+    # The data segment is at the end of the file
+    offset = os.fstat(fp.fileno()).st_size - nb_voxels * 4
+    if offset <= 0:
+        raise Exception('{0} is too small to hold {1} voxels.'
+                        .format(fp.name, nb_voxels))
+
+    if buf is None:
+        # The payload is only copied once, by the conversion to native
+        # float32. It is done inside the mapping so no view outlives it.
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = np.frombuffer(mm, dtype=dtype, count=nb_voxels,
+                                 offset=offset).astype(np.float32)
+    else:
+        fp.seek(offset)
+        if fp.readinto(buf) != len(buf):
+            raise Exception('Could not read the data of {0}.'.format(fp.name))
+        data = np.frombuffer(buf, dtype=dtype)
+
+    data = _reorient(data, shape)
+
+    if out is None:
+        # A view of a reused buffer must not be returned
+        return data if buf is None else data.astype(np.float32)
+
+    out[...] = data
+    return out
+
+
+def _reorient(data, shape):
+    """
+    Reshape and reorient flat fdf data.
+
+    Parameters
+    ----------
+    data: Flat numpy array of the fdf data, as stored in the file
+    shape: Image dimensions, as found in the header matrix
+
+    Return
+    ------
+    data: Reoriented view of the fdf data
+    """
+    # Reshape the data according to image dimensions
+    data = data.reshape(shape[::-1]).squeeze()
+
+    # Reorient the axes. A rotation by 270 degrees followed by a flip of
+    # the second axis only swaps the first two axes, so this is a single
+    # transpose view of the data.
+    if len(shape) != 2:
+        return data.transpose(1, 2, 0)
+
+    return data.T
 
 
 def read_directory(path):
@@ -222,21 +375,59 @@ def read_directory(path):
     data: Numpy array containing data
     final_header: Header information
     """
-    files = glob.glob(os.path.join(path, '*.fdf'))
-    files.sort()
-
-    all_headers, all_data = zip(*[read_file(fl) for fl in files])
+    # Like glob('*.fdf'), hidden files are skipped
+    files = sorted(entry.path for entry in os.scandir(path)
+                   if entry.is_file() and entry.name.endswith('.fdf')
+                   and not entry.name.startswith('.'))
 
-    if not all_headers:
+    if not files:
         return None
 
-    final_header = all_headers[0]
-
-    # Fix data axis
-    all_data = np.array(all_data)
-    if len(all_data.shape) < 4:
-        all_data = np.transpose(all_data, (1, 2, 0))
-
+    # All the files of an acquisition share the same header layout, only the
+    # first one is parsed.
+    with open(files[0], 'rb') as fp:
+        final_header, nb_voxels, dtype = _scan_header(fp)
+        first_data = _load_payload(fp, nb_voxels, dtype,
+                                   final_header['shape'])
+
+    # Fix data axis: files are stacked on the last axis and 3D volumes are
+    # put in (y, z, x) order. The output is allocated directly in its final
+    # layout and each file is converted straight into its place.
+    is_2d = first_data.ndim < 3
+    axes = (0, 1) if is_2d else (1, 2, 0)
+    inverse_axes = tuple(np.argsort(axes))
+    first_data = first_data.transpose(axes)
+    all_data = np.empty(first_data.shape + (len(files),), dtype=np.float32)
+    all_data[..., 0] = first_data
+
+    first_shape = [int(x) for x in final_header['shape']]
+
+    # Files have the same size, each thread reuses a single read buffer
+    thread_data = threading.local()
+
+    def _read_into(index):
+        if not hasattr(thread_data, 'buf'):
+            thread_data.buf = bytearray(nb_voxels * 4)
+
+        with open(files[index], 'rb') as fp:
+            # Only the first header is parsed, make sure this slice has the
+            # same dimensions before reading it with the same layout.
+            shape = _read_matrix(fp)
+            if shape != first_shape:
+                raise Exception('{0} has a matrix of {1} while {2} has a '
+                                'matrix of {3}.'.format(files[index], shape,
+                                                        files[0],
+                                                        first_shape))
+
+            _load_payload(fp, nb_voxels, dtype, final_header['shape'],
+                          out=all_data[..., index].transpose(inverse_axes),
+                          buf=thread_data.buf)
+
+    # Slices are independent, their reads can overlap
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(_read_into, range(1, len(files))))
+
+    if is_2d:
         # Set real shape
         final_header['shape'] = all_data.shape
 
@@ -257,8 +448,6 @@ def read_directory(path):
 
             all_data = all_data.reshape(final_header['shape'])
     else:
-        all_data = np.transpose(all_data, (3, 2, 1, 0))
-        all_data = np.transpose(all_data, (1, 0, 2, 3))
         final_header['shape'] = all_data.shape
         final_header['voxel_dim'].append(1.0)
 
@@ -317,9 +506,15 @@ def save_babel(dwi_data, dwi_header, b0_data, b0_header,
     nifti1_header = nifti1_dwi_header
 
     if 'orientation' in nifti1_header:
-        orientation = np.identity(4)
-        orientation[:3, :3] = nifti1_header['orientation'].reshape(3, 3)
-        affine = np.linalg.inv(orientation)
+        rotation = nifti1_header['orientation'].reshape(3, 3)
+        affine = np.identity(4)
+
+        # The inverse of a rotation is its transpose
+        if np.allclose(rotation @ rotation.T, np.identity(3), atol=1e-6):
+            affine[:3, :3] = rotation.T
+        else:
+            affine[:3, :3] = rotation
+            affine = np.linalg.inv(affine)
 
     write_gradient_information(dwi_header, b0_header,
                                bval_path, bvec_path, flip, swap)
@@ -365,17 +560,14 @@ def write_gradient_information(dwi_header, b0_header,
        all(k in b0_header for k in keys):
 
         if bval_path:
-            bvals = b0_header['bvalue'] + dwi_header['bvalue']
-            with open(bval_path, 'w') as bval_file:
-                bval_file.write(' '.join(str(i) for i in bvals))
+            bvals = np.concatenate((b0_header['bvalue'],
+                                    dwi_header['bvalue']))
+            np.savetxt(bval_path, bvals[None, :], fmt='%g')
 
         if bvec_path:
-            bvecs = np.zeros((3,
-                              len(b0_header['diff_x'] + dwi_header['diff_x'])))
-
-            bvecs[0, :] = b0_header['diff_x'] + dwi_header['diff_x']
-            bvecs[1, :] = b0_header['diff_y'] + dwi_header['diff_y']
-            bvecs[2, :] = b0_header['diff_z'] + dwi_header['diff_z']
+            bvecs = np.vstack([np.concatenate((b0_header[key],
+                                               dwi_header[key]))
+                               for key in ('diff_x', 'diff_y', 'diff_z')])
 
             if flip:
                 axes = [str_to_index(axis) for axis in list(flip)]
@@ -1,7 +1,158 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from scilpy.io.varian_fdf import (load_fdf, read_directory, read_file,
+                                  write_gradient_information)
+
+tmp_dir = tempfile.TemporaryDirectory()
+
+# Synthetic fdf header, the matrix line uses a tab on purpose
+FDF_HEADER = ('#!/usr/local/fdf/startup\n'
+              'float  rank = {rank};\n'
+              'char  *storage = "float";\n'
+              'int    bits = 32;\n'
+              'float\tmatrix[] = {{{matrix}}};\n'
+              'char  *abscissa[] = {{"cm", "cm"}};\n'
+              'float  origin[] = {{-1.920000,-1.920000}};\n'
+              'float  roi[] = {{3.840000,3.840000,0.035000}};\n'
+              'char  *file = "/data/slice{slice_no:03d}.fdf";\n'
+              'int    slice_no = {slice_no};\n'
+              'int    echo_no = 1;\n'
+              'float  orientation[] = '
+              '{{0.0,1.0,0.0,-1.0,0.0,0.0,0.0,0.0,1.0}};\n'
+              'char  *studyid = "s_2020";\n'
+              'float  array_dim = {array_dim};\n'
+              'int    bigendian = 1;\n')
+
+PROCPAR = ('bvalue 1 1 0\n'
+           '3 0 1000 1000\n'
+           'bvaluePP 1 1 0\n'
+           '3 5 5 5\n'
+           'dpe 1 1 0\n'
+           '3 0 0.5 -0.2\n'
+           'dro 1 1 0\n'
+           '3 0 0.5 0.1\n'
+           'dsl 1 1 0\n'
+           '3 1 0.70710678 0.3\n')
+
+
+def _write_fdf(path, raw, slice_no=1, array_dim=1):
+    # raw is in file order, i.e. shaped as the reversed matrix
+    header = FDF_HEADER.format(rank=raw.ndim,
+                               matrix=', '.join(str(i)
+                                                for i in raw.shape[::-1]),
+                               slice_no=slice_no,
+                               array_dim=array_dim)
+    with open(path, 'wb') as fdf_file:
+        fdf_file.write(header.encode() + b'\n\x0c\n')
+        fdf_file.write(raw.astype('>f4').tobytes())
+
+
+def _reference_orientation(raw):
+    # Reorientation as it was done before being collapsed to a transpose
+    data = raw
+    if raw.ndim != 2:
+        data = data.transpose(2, 1, 0)
+    return np.rot90(data, 3)[:, ::-1]
+
 
 def test_help_option(script_runner):
     ret = script_runner.run('scil_convert_fdf.py', '--help')
     assert ret.success
+
+
+def test_read_file():
+    rng = np.random.RandomState(0)
+    for name, file_shape in (('2d.fdf', (5, 6)), ('3d.fdf', (4, 5, 6))):
+        raw = rng.rand(*file_shape).astype(np.float32)
+        path = os.path.join(tmp_dir.name, name)
+        _write_fdf(path, raw)
+
+        header, data = read_file(path)
+        assert data.dtype == np.float32
+        assert np.array_equal(data, _reference_orientation(raw))
+        assert header['studyid'] == 's_2020'
+        assert header['xyz_units'] == 'mm'
+        assert np.array_equal(header['shape'], file_shape[::-1])
+
+
+def test_read_directory_2d():
+    rng = np.random.RandomState(1)
+    in_dir = os.path.join(tmp_dir.name, 'slices')
+    os.mkdir(in_dir)
+
+    slices = [rng.rand(5, 6).astype(np.float32) for _ in range(6)]
+    for i, raw in enumerate(slices):
+        _write_fdf(os.path.join(in_dir, 'slice{:03d}.fdf'.format(i + 1)),
+                   raw, slice_no=i + 1, array_dim=2)
+
+    data, header = read_directory(in_dir)
+    expected = np.transpose([_reference_orientation(raw) for raw in slices],
+                            (1, 2, 0)).reshape((6, 5, 3, 2))
+    assert data.dtype == np.float32
+    assert np.array_equal(data, expected)
+    assert header['shape'] == (6, 5, 3, 2)
+    assert np.allclose(header['voxel_dim'], [6.4, 7.68, 0.35, 1])
+
+
+def test_read_directory_3d():
+    rng = np.random.RandomState(2)
+    in_dir = os.path.join(tmp_dir.name, 'volumes')
+    os.mkdir(in_dir)
+
+    volumes = [rng.rand(4, 5, 6).astype(np.float32) for _ in range(3)]
+    for i, raw in enumerate(volumes):
+        _write_fdf(os.path.join(in_dir, 'img{:03d}.fdf'.format(i)), raw)
+
+    data, header = read_directory(in_dir)
+    expected = np.transpose([_reference_orientation(raw) for raw in volumes],
+                            (3, 2, 1, 0)).transpose((1, 0, 2, 3))
+    assert np.array_equal(data, expected)
+    assert header['shape'] == expected.shape
+
+
+def test_read_directory_mismatched_slices():
+    rng = np.random.RandomState(3)
+    for other_shape in ((2, 2), (8, 8)):
+        in_dir = os.path.join(tmp_dir.name,
+                              'mismatched_{}'.format(other_shape[0]))
+        os.mkdir(in_dir)
+        _write_fdf(os.path.join(in_dir, 'slice001.fdf'),
+                   rng.rand(4, 4).astype(np.float32), slice_no=1)
+        _write_fdf(os.path.join(in_dir, 'slice002.fdf'),
+                   rng.rand(*other_shape).astype(np.float32), slice_no=2)
+
+        with pytest.raises(Exception, match='slice002.fdf has a matrix'):
+            read_directory(in_dir)
+
+
+def test_gradient_information():
+    in_dir = os.path.join(tmp_dir.name, 'dwi')
+    os.mkdir(in_dir)
+    _write_fdf(os.path.join(in_dir, 'slice001.fdf'),
+               np.zeros((5, 6), dtype=np.float32))
+    with open(os.path.join(in_dir, 'procpar'), 'w') as procpar:
+        procpar.write(PROCPAR)
+
+    _, header = load_fdf(in_dir)
+
+    # Only the exact bvalue tag is used, not bvaluePP
+    assert np.array_equal(header['bvalue'], [0, 1000, 1000])
+    assert np.array_equal(header['diff_x'], [0, -0.5, 0.2])
+
+    bval_path = os.path.join(tmp_dir.name, 'dwi.bval')
+    bvec_path = os.path.join(tmp_dir.name, 'dwi.bvec')
+    write_gradient_information(header, header, bval_path, bvec_path)
+
+    with open(bval_path) as bval_file:
+        assert bval_file.read() == '0 1000 1000 0 1000 1000\n'
+    assert np.allclose(np.loadtxt(bvec_path),
+                       [[0, -0.5, 0.2, 0, -0.5, 0.2],
+                        [0, 0.5, 0.1, 0, 0.5, 0.1],
+                        [1, 0.70710678, 0.3, 1, 0.70710678, 0.3]])